@@ -1,128 +1,284 @@
 #!/usr/bin/env python3
 
 import argparse
+import functools
+import hashlib
 import time
 import json
 import os
 import re
 from select import select
+import selectors
 import socket
 
 import paho.mqtt.client as mqtt
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 MARK_PROMPT = b"\rpylon>"
 MARK_BEGIN = b"\n\r@\r\r\n"
 MARK_END = b"\r\n\rCommand completed successfully\r\n\r$$\r\n" + MARK_PROMPT
 
+LEN_PROMPT = len(MARK_PROMPT)
+LEN_END = len(MARK_END)
+
+READ_TIMEOUT = 6  # seconds to wait for a complete response
+READ_SIZE = 4096
+RCVBUF_SIZE = 65536
+
+_COLUMN_RE = re.compile(r"[^ ]+ +")
+
+_NUMERIC_FIELDS = ("Power", "Volt", "Curr", "Tempr", "Tlow", "Thigh", "Vlow", "Vhigh", "MosTempr")
+_BAT_NUMERIC_FIELDS = ("Battery", "Volt", "Curr", "Tempr", "Base_State", "Volt._State", "Curr._State", "Temp._State", "SOC", "Coulomb", "BAL")
+
+
+def mqtt_on_disconnect(client, userdata, rc):
+    if rc:
+        print(f"Disconnected from mqtt server ({rc}), reconnecting")
 
 def mqtt_connect(*, server, username, password, client_id):
     client = mqtt.Client(client_id=client_id)
     client.username_pw_set(username, password)
+    client.on_disconnect = mqtt_on_disconnect
+    client.reconnect_delay_set(min_delay=1, max_delay=30)
     client.connect(server)
     return client
 
-def network_command(device, command, *, retries=1, checkframe=True):
-    print(f"Sending command {command}")
-    command_bytes = command.encode()
-    mark_end = MARK_END if checkframe else MARK_PROMPT
-    try:
+class _ConnectionDropped(RuntimeError):
+    pass
+
+class PylontechConnection:
+    """Battery console over TCP, kept open across commands and reopened on error."""
+
+    def __init__(self, device):
+        self.device = device  # device should be a tuple (host, port)
+        self.sock = None
+        self.selector = selectors.DefaultSelector()
+        self.buffer = bytearray()
+
+    def connect(self):
         try:
             # Create a TCP/IP socket
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect(device)  # device should be a tuple (host, port)
+            try:
+                # Commands are tiny writes, don't let Nagle hold them back
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF_SIZE)
+                # Detect a dead device on the otherwise idle connection between polls
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+                if hasattr(socket, "TCP_KEEPIDLE"):
+                    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 30)
+                # Slow bridges may take a while to accept, only bound the later I/O
+                sock.connect(self.device)
+                sock.settimeout(1)
+            except Exception:
+                sock.close()
+                raise
         except Exception as e:
-            raise RuntimeError(f"Error connecting to device {device}") from e
+            raise RuntimeError(f"Error connecting to device {self.device}") from e
+        self.sock = sock
+        self.selector.register(sock, selectors.EVENT_READ)
+        self.buffer.clear()
 
-        sock.sendall(command_bytes + b"\n")
-
-        response = b""
-        timeout_counter = 0
-        while mark_end not in response:
-            if timeout_counter > 5:
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.selector.unregister(self.sock)
+            finally:
+                self.sock.close()
+                self.sock = None
+        self.buffer.clear()
+
+    def read(self, mark_end, len_end):
+        buffer = self.buffer
+        scan_from = 0
+        received = False
+        deadline = time.monotonic() + READ_TIMEOUT
+        while True:
+            end = buffer.find(mark_end, scan_from)
+            if end >= 0:
+                end += len_end
+                response = bytes(buffer[:end])
+                del buffer[:end]
+                return response
+            # Only bytes received from now on can complete the end mark
+            scan_from = max(0, len(buffer) - len_end + 1)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.selector.select(remaining):
                 raise RuntimeError("Read operation timed out")
-            sock.settimeout(1)
             try:
-                data = sock.recv(256)
-                if not data:
-                    timeout_counter += 1
-                    continue
-                response += data
-            except socket.timeout:
-                timeout_counter += 1
-                continue
-
-        response = response.rstrip()
-        if checkframe:
-            if not (response.startswith(command.encode() + MARK_BEGIN) and response.endswith(mark_end)):
-                raise Exception("Response frame corrupt")
-            response = response[len(command) + len(MARK_BEGIN):-len(mark_end)]
-        return response.decode()
-    except Exception as e:
-        if not retries:
-            raise RuntimeError(f"Error sending command {command}")
-    finally:
+                data = self.sock.recv(READ_SIZE)
+            except ConnectionError:
+                data = b""
+            if not data:
+                if not received:
+                    raise _ConnectionDropped("Connection closed by device")
+                raise RuntimeError("Connection closed by device")
+            received = True
+            buffer += data
+
+    def exchange(self, command_line, mark_end, len_end):
+        reused = self.sock is not None
+        if not reused:
+            self.connect()
         try:
-            sock.close()
-        except Exception:
-            pass
-    print(f"Error sending command {command}, {retries} retries remaining")
-    time.sleep(0.1)
+            self.sock.sendall(command_line)
+            return self.read(mark_end, len_end)
+        except (ConnectionError, _ConnectionDropped):
+            if not reused:
+                raise
+        # The device dropped the idle connection before answering, reconnect
+        # once without spending one of the command retries
+        self.close()
+        self.connect()
+        self.sock.sendall(command_line)
+        return self.read(mark_end, len_end)
+
+    def cmd(self, command, *, retries=1, checkframe=True):
+        print(f"Sending command {command}")
+        command_bytes = command.encode()
+        command_line = command_bytes + b"\n"
+        expected_prefix = command_bytes + MARK_BEGIN
+        len_prefix = len(expected_prefix)
+        mark_end = MARK_END if checkframe else MARK_PROMPT
+        len_end = LEN_END if checkframe else LEN_PROMPT
+        for attempt in range(retries + 1):
+            if attempt:
+                print(f"Error sending command {command}, {retries - attempt + 1} retries remaining")
+                time.sleep(0.1)
+                # A late reply to the failed attempt may still be in flight on
+                # the old socket, so recover on a fresh connection
+                self.close()
+                try:
+                    # Try to clear prompt and recover
+                    self.connect()
+                    self.sock.sendall(b"\n")
+                    self.read(MARK_PROMPT, LEN_PROMPT)
+                except Exception:
+                    self.close()
+            try:
+                response = self.exchange(command_line, mark_end, len_end)
+                if checkframe:
+                    # Whitespace trailing the previous frame may precede this one
+                    response = response.lstrip()
+                    # The read already ends the frame on the end mark, only the echo needs checking
+                    if response[:len_prefix] != expected_prefix:
+                        raise Exception("Response frame corrupt")
+                    response = response[len_prefix:-len_end]
+                return response.decode()
+            except Exception as e:
+                error = e
+        self.close()
+        raise RuntimeError(f"Error sending command {command}") from error
+
+def network_command(device, command, *, retries=1, checkframe=True):
+    if isinstance(device, PylontechConnection):
+        return device.cmd(command, retries=retries, checkframe=checkframe)
+    conn = PylontechConnection(device)
     try:
-        network_command(device, "", retries=0, checkframe=False) # Try to clear prompt and recover
-    except Exception:
-        pass
-    return network_command(device, command, retries=retries-1)
+        return conn.cmd(command, retries=retries, checkframe=checkframe)
+    finally:
+        conn.close()
+
+def _serial_read(file, mark_end, len_end):
+    response = bytearray()
+    scan_from = 0
+    deadline = time.monotonic() + READ_TIMEOUT
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not select([file], [], [], remaining)[0]:
+            raise RuntimeError("Read operation timed out")
+        response += os.read(file, READ_SIZE)
+        end = response.find(mark_end, scan_from)
+        if end >= 0:
+            # Drop anything received past the end mark
+            return bytes(response[:end + len_end])
+        # Only bytes received from now on can complete the end mark
+        scan_from = max(0, len(response) - len_end + 1)
+
+def _serial_write(file, data):
+    ready = select([], [file], [], 1)
+    if not ready[1]:
+        raise RuntimeError("Write operation timed out")
+    os.write(file, data)
 
 def serial_command(device, command, *, retries=1, checkframe=True):
     print(f"Sending command {command}")
     command_bytes = command.encode()
+    command_line = command_bytes + b"\n"
+    expected_prefix = command_bytes + MARK_BEGIN
+    len_prefix = len(expected_prefix)
     mark_end = MARK_END if checkframe else MARK_PROMPT
+    len_end = LEN_END if checkframe else LEN_PROMPT
+    file = None
     try:
-        try:
-            file = os.open(device, os.O_RDWR | os.O_NONBLOCK)
-        except Exception as e:
-            raise RuntimeError(f"Error opening device {device}") from e
-
-        ready = select([], [file], [], 1)
-        if not ready[1]:
-            raise RuntimeError("Write operation timed out")
-        os.write(file, command_bytes + b"\n")
-
-        response = b""
-        timeout_counter = 0
-        while mark_end not in response:
-            if timeout_counter > 5:
-                raise RuntimeError("Read operation timed out")
-            ready = select([file], [], [], 1)
-            if not ready[0]:
-                timeout_counter += 1
-                continue
-            response += os.read(file, 256)
-
-        response = response.rstrip()
-        if checkframe:
-            if not (response.startswith(command.encode() + MARK_BEGIN) and response.endswith(mark_end)):
-                raise Exception("Response frame corrupt")
-            response = response[len(command) + len(MARK_BEGIN):-len(mark_end)]
-        return response.decode()
-    except Exception as e:
-        if not retries:
-            raise RuntimeError(f"Error sending command {command}")
+        for attempt in range(retries + 1):
+            if attempt:
+                print(f"Error sending command {command}, {retries - attempt + 1} retries remaining")
+                time.sleep(0.1)
+                if file is not None:
+                    try:
+                        # Try to clear prompt and recover, keeping the device open
+                        _serial_write(file, b"\n")
+                        _serial_read(file, MARK_PROMPT, LEN_PROMPT)
+                    except Exception:
+                        os.close(file)
+                        file = None
+            try:
+                if file is None:
+                    try:
+                        file = os.open(device, os.O_RDWR | os.O_NONBLOCK)
+                    except Exception as e:
+                        raise RuntimeError(f"Error opening device {device}") from e
+
+                _serial_write(file, command_line)
+                response = _serial_read(file, mark_end, len_end)
+                if checkframe:
+                    # The read already ends the frame on the end mark, only the echo needs checking
+                    if response[:len_prefix] != expected_prefix:
+                        raise Exception("Response frame corrupt")
+                    response = response[len_prefix:-len_end]
+                return response.decode()
+            except Exception as e:
+                error = e
+        raise RuntimeError(f"Error sending command {command}") from error
     finally:
-        try:
+        if file is not None:
             os.close(file)
-        except Exception:
-            pass
-    print(f"Error sending command {command}, {retries} retries remaining")
-    time.sleep(0.1)
-    try:
-        serial_command(device, "", retries=0, checkframe=False) # Try to clear prompt and recover
-    except Exception:
-        pass
-    return serial_command(device, command, retries=retries-1)
 
 
+# The table layout only changes with the firmware, so parse each header once.
+# The bound covers the pwr and bat tables of stacks mixing firmware versions.
+@functools.lru_cache(maxsize=16)
+def _parse_header(header):
+    colstart = [0]
+    for m in _COLUMN_RE.findall(header.rstrip()):
+        colstart.append(colstart[-1] + len(m))
+    slices = tuple(zip(colstart, colstart[1:] + [None]))
+    headers = tuple(header[start:end].strip() for start, end in slices)
+    # Rows whose values all sit in their header columns leave a space
+    # before every column start and match this in a single pass
+    row_re = re.compile("".join(f"(.{{{end - start - 1}}}) " for start, end in slices[:-1]) + "(.*)")
+    return headers, slices, row_re
+
+def _split_row(line, slices, row_re):
+    m = row_re.match(line)
+    if m is not None:
+        return [value.strip() for value in m.groups()]
+    values = []
+    for start, end in slices:
+        # A value may start one character left of its header column
+        if start and line[start-1:start] not in (" ", ""):
+            start -= 1
+        if end is not None and line[end-1:end] not in (" ", ""):
+            end -= 1
+        values.append(line[start:end].strip())
+    return values
+
 def get_power(device, network=False):
     if network:
         response = network_command(device, "pwr")
@@ -131,38 +287,25 @@ def get_power(device, network=False):
     try:
         lines = response.split("\n")
 
-        colstart = [0]
-        for m in re.findall(r"([^ ]+ +)", lines[0].rstrip()):
-            colstart.append(colstart[-1] + len(m))
-
-        def getcell(line, cellno):
-            linelen = len(line)
-            offset1 = min(linelen, colstart[cellno])
-            if offset1 and line[offset1-1] != " ":
-                offset1 -= 1
-            offset2 = min(linelen, colstart[cellno+1] if cellno+1 < len(colstart) else len(line))
-            if line[offset2-1] != " ":
-                offset2 -= 1
-            return line[offset1:offset2].strip()
-
-        headers = [getcell(lines[0], i) for i in range(len(colstart))]
+        headers, slices, row_re = _parse_header(lines[0])
 
         items = []
         for line in lines[1:]:
-            values = [getcell(line, i) for i in range(len(colstart))]
+            values = _split_row(line, slices, row_re)
             item = dict(zip(headers, values))
             if item["Base.St"] == "Absent":
                 continue
 
-            for k in ("Power", "Volt", "Curr", "Tempr", "Tlow", "Thigh", "Vlow", "Vhigh", "MosTempr"):
-                try:
-                    item[k] = int(item[k])
-                except Exception:
-                    pass
-            try:
-                item["Coulomb"] = int(item["Coulomb"][:-1])
-            except Exception:
-                pass
+            for k in _NUMERIC_FIELDS:
+                v = item.get(k)
+                if v is not None and v.lstrip("-").isdigit():
+                    item[k] = int(v)
+            v = item.get("Coulomb")
+            if v and not v[-1].isdigit():
+                # Drop the unit, some firmwares print the bare number
+                v = v[:-1]
+            if v is not None and v.lstrip("-").isdigit():
+                item["Coulomb"] = int(v)
             items.append(item)
 
         return items
@@ -177,38 +320,25 @@ def get_bat(device, index, network=False):
     try:
         lines = response.split("\n")
         lines[0] = lines[0].replace(" State", "_State")
-        colstart = [0]
-        for m in re.findall(r"([^ ]+ +)", lines[0].rstrip()):
-            colstart.append(colstart[-1] + len(m))
-
-        def getcell(line, cellno):
-            linelen = len(line)
-            offset1 = min(linelen, colstart[cellno])
-            if offset1 and line[offset1-1] != " ":
-                offset1 -= 1
-            offset2 = min(linelen, colstart[cellno+1] if cellno+1 < len(colstart) else len(line))
-            if line[offset2-1] != " ":
-                offset2 -= 1
-            return line[offset1:offset2].strip()
-
-        headers = [getcell(lines[0], i) for i in range(len(colstart))]
+        headers, slices, row_re = _parse_header(lines[0])
 
         items = []
         for line in lines[1:]:
-            values = [getcell(line, i) for i in range(len(colstart))]
+            values = _split_row(line, slices, row_re)
             item = dict(zip(headers, values))
             if item["Base_State"] == "Absent":
                 continue
 
-            for k in ("Battery","Volt","Curr","Tempr","Base_State","Volt._State","Curr._State","Temp._State","SOC","Coulomb","BAL"):
-                try:
-                    item[k] = int(item[k])
-                except Exception:
-                    pass
-            try:
-                item["Coulomb"] = int(item["Coulomb"][:-1])
-            except Exception:
-                pass
+            for k in _BAT_NUMERIC_FIELDS:
+                v = item.get(k)
+                if v is not None and v.lstrip("-").isdigit():
+                    item[k] = int(v)
+            v = item.get("Coulomb")
+            # Already converted above when printed without a unit
+            if isinstance(v, str) and v and not v[-1].isdigit():
+                v = v[:-1]
+                if v.lstrip("-").isdigit():
+                    item["Coulomb"] = int(v)
             items.append(item)
 
         return items
@@ -231,20 +361,50 @@ def get_info(device, index, network=False):
     except Exception as e:
         raise RuntimeError(f"Error parsing power ({response})") from e
 
-def send_data(client, topic, pwrdata, batdata):
+if orjson is not None:
+    json_dumps = orjson.dumps
+else:
+    def json_dumps(data):
+        return json.dumps(data).encode()
+
+def payload_encoder(payload_format):
+    if payload_format == "json":
+        return json_dumps
+    if payload_format == "json+zstd":
+        import zstandard
+        compress = zstandard.ZstdCompressor(level=3).compress
+        return lambda data: compress(json_dumps(data))
+    if payload_format == "msgpack":
+        import msgpack
+        return msgpack.packb
+    raise ValueError(f"Unknown payload format {payload_format}")
+
+def publish_changed(client, published, topic, payload, snapshot=False):
+    # Payloads are only sent again when they change, except on snapshot
+    # iterations which republish everything retained for new subscribers
+    data = payload if isinstance(payload, bytes) else str(payload).encode()
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    if not snapshot and published.get(topic) == digest:
+        return
+    if client.publish(topic, payload, 0, snapshot).rc == mqtt.MQTT_ERR_SUCCESS:
+        published[topic] = digest
+
+def send_data(client, topic, pwrdata, batdata, encode=json_dumps, published=None, snapshot=False):
+    if published is None:
+        published = {}
     try:
         # Loop on battery array
-        bat_count = json.loads(pwrdata).__len__()
-        for index, item in enumerate(json.loads(pwrdata)):
+        bat_count = len(pwrdata)
+        for index, item in enumerate(pwrdata):
             # publish each item on separated topic ending by number
-            client.publish(f"{topic}/{index}/pwr", json.dumps(item), 0, False)
+            publish_changed(client, published, f"{topic}/{index}/pwr", encode(item), snapshot)
         # publish on all
-        client.publish(f"{topic}", pwrdata, 0, False)
-        client.publish(f"{topic}/count", bat_count, 0, False)
+        publish_changed(client, published, f"{topic}", encode(pwrdata), snapshot)
+        publish_changed(client, published, f"{topic}/count", bat_count, snapshot)
         # Loop on battery array
-        for index, item in enumerate(json.loads(batdata)):
+        for index, item in enumerate(batdata):
             # publish each item on separated topic ending by number
-            client.publish(f"{topic}/{index}/bat", json.dumps(item), 0, False)
+            publish_changed(client, published, f"{topic}/{index}/bat", encode(item), snapshot)
     except Exception as e:
         raise RuntimeError("Error sending data to mqtt server") from e
 
@@ -260,48 +420,73 @@ def main(
     mqtt_pass,
     mqtt_client_id,
     mqtt_topic,
+    payload_format="json",
+    snapshot_every=10,
     sleep_iteration=0,
 ):
+    encode = payload_encoder(payload_format)
     client = mqtt_connect(
         server=mqtt_server,
         username=mqtt_user,
         password=mqtt_pass,
         client_id=mqtt_client_id,
     )
+    # Keep a single connection to the battery across iterations
+    conn = PylontechConnection((host, int(port))) if mode else None
+    # Digests of the last payload published on each topic
+    published = {}
+    iteration = 0
     # Info publish flag
     info_publish = False
     # Count number of batteries
     bat_count = 0
     print(f"Reading from battery\n")
-    while True:
-        start = time.time()
-        if mode:
-            pwrdata = json.dumps(get_power((host, int(port)), network=True))
-            # count number of batteries using pwrdata
-            bat_count = json.loads(pwrdata).__len__()
+    # Run the mqtt network loop in the background so publishing never blocks polling
+    client.loop_start()
+    next_deadline = time.monotonic()
+    try:
+        while True:
             batdata = []
-            for i in range(bat_count):
-                batdata.append(get_bat((host, int(port)), i+1, network=True))
-                print("battery", batdata, "\n")
-        else:
-            pwrdata = json.dumps(get_power(device))
-            for i in range(bat_count):
-                batdata.append(get_bat((host, int(port)), i+1, network=True))
-                print("battery", batdata, "\n")
-        print("power", pwrdata, "\n")
-        send_data(client, mqtt_topic, pwrdata, json.dumps(batdata))
-        # Publish info only once
-        if not info_publish:
-            info_publish = True
-            for i in range(bat_count):
-                try:
-                    client.publish(f"{mqtt_topic}/{i}/info", json.dumps(get_info((host, int(port)), i+1, network=True)), 0, True)
-                except Exception as e:
-                    raise RuntimeError("Error sending data to mqtt server") from e
-        time.sleep(sleep_iteration)
+            if mode:
+                pwrdata = get_power(conn, network=True)
+                # count number of batteries using pwrdata
+                bat_count = len(pwrdata)
+                for i in range(bat_count):
+                    batdata.append(get_bat(conn, i+1, network=True))
+                    print("battery", batdata, "\n")
+            else:
+                pwrdata = get_power(device)
+                for i in range(bat_count):
+                    batdata.append(get_bat(conn, i+1, network=True))
+                    print("battery", batdata, "\n")
+            print("power", pwrdata, "\n")
+            send_data(client, mqtt_topic, pwrdata, batdata, encode, published, iteration % snapshot_every == 0)
+            # Publish info only once
+            if not info_publish:
+                info_publish = True
+                for i in range(bat_count):
+                    try:
+                        client.publish(f"{mqtt_topic}/{i}/info", encode(get_info(conn, i+1, network=True)), 0, True)
+                    except Exception as e:
+                        raise RuntimeError("Error sending data to mqtt server") from e
+            iteration += 1
+            # Keep a steady cadence between iteration starts, don't try to
+            # catch up after a poll that overran the interval
+            next_deadline = max(next_deadline + sleep_iteration, time.monotonic())
+            time.sleep(max(0, next_deadline - time.monotonic()))
+    finally:
+        if conn is not None:
+            conn.close()
+        client.disconnect()
+        client.loop_stop()
 
 
 if __name__ == "__main__":
+    def positive_int(value):
+        number = int(value)
+        if number < 1:
+            raise argparse.ArgumentTypeError(f"{value} is not a positive integer")
+        return number
     def env(var, val=None):
         return {"default": os.environ.get(var)} if os.environ.get(var) else \
                {"default": val} if val is not None else \
@@ -319,6 +504,8 @@ if __name__ == "__main__":
     parser.add_argument("--mqtt-pass", **env("MQTT_PASS"), help="MQTT password")
     parser.add_argument("--mqtt-client-id", **env("MQTT_CLIENT_ID"), help="MQTT client id")
     parser.add_argument("--mqtt-topic", **env("MQTT_TOPIC"), help="MQTT topic for data")
+    parser.add_argument("--payload-format", choices=("json", "json+zstd", "msgpack"), **env("PAYLOAD_FORMAT", "json"), help="Encoding of the published payloads")
+    parser.add_argument("--snapshot-every", type=positive_int, **env("SNAPSHOT_EVERY", 10), help="Iterations between retained republishes of all topics")
     parser.add_argument("--sleep-iteration", type=float, **env("SLEEP_ITERATION", 30), help="Seconds between iteration starts")
     args = parser.parse_args()
 
@@ -332,5 +519,7 @@ if __name__ == "__main__":
         mqtt_pass=args.mqtt_pass,
         mqtt_client_id=args.mqtt_client_id,
         mqtt_topic=args.mqtt_topic,
+        payload_format=args.payload_format,
+        snapshot_every=args.snapshot_every,
         sleep_iteration=args.sleep_iteration,
     )
@@ -13,6 +13,8 @@ export MQTT_USER=${MQTT_USER:-"$(config mqtt_user)"}
 export MQTT_PASS=${MQTT_PASS:-"$(config mqtt_pass)"}
 export MQTT_CLIENT_ID=${MQTT_CLIENT_ID:-"$(config mqtt_client_id)"}
 export MQTT_TOPIC=${MQTT_TOPIC:-"$(config mqtt_topic)"}
+export PAYLOAD_FORMAT=${PAYLOAD_FORMAT:-"$(config payload_format)"}
+export SNAPSHOT_EVERY=${SNAPSHOT_EVERY:-"$(config snapshot_every)"}
 export SLEEP_INTERVAL=${SLEEP_INTERVAL:-"$(config sleep_interval)"}
 
 echo ""
@@ -26,6 +28,8 @@ echo "  MQTT_USER: $MQTT_USER"
 echo "  MQTT_PASS: $MQTT_PASS"
 echo "  MQTT_CLIENT_ID: $MQTT_CLIENT_ID"
 echo "  MQTT_TOPIC: $MQTT_TOPIC"
+echo "  PAYLOAD_FORMAT: $PAYLOAD_FORMAT"
+echo "  SNAPSHOT_EVERY: $SNAPSHOT_EVERY"
 echo "  SLEEP_INTERVAL: $SLEEP_INTERVAL"
 echo ""
 
@@ -2,15 +2,28 @@
 
 import argparse
 
-from monitor import get_info, get_bat
+from monitor import PylontechConnection, serial_command
 
 if __name__ == "__main__":
-    # parser = argparse.ArgumentParser(description="Send a command to the battery and read the response")
-    # parser.add_argument("device", help="Battery IO device")
-    # parser.add_argument("command", help="Command to send")
-    # args = parser.parse_args()
+    parser = argparse.ArgumentParser(description="Send commands to the battery and read the responses")
+    parser.add_argument("device", help="Battery IO device, or host:port with --network")
+    parser.add_argument("command", nargs="+", help="Commands to send, in order")
+    parser.add_argument("--network", action="store_true", help="Connect to the battery over TCP")
+    args = parser.parse_args()
 
-    # response = serial_command(args.device, args.command, checkframe=False)
-    response = get_info(("192.168.2.227", 9999), 2, network=True)
-    print(f"Response length: {len(response)}")
-    print(response)
+    conn = None
+    if args.network:
+        host, port = args.device.rsplit(":", 1)
+        # All commands share one connection
+        conn = PylontechConnection((host, int(port)))
+    try:
+        for command in args.command:
+            if conn is not None:
+                response = conn.cmd(command, checkframe=False)
+            else:
+                response = serial_command(args.device, command, checkframe=False)
+            print(f"Response length: {len(response)}")
+            print(response)
+    finally:
+        if conn is not None:
+            conn.close()